@@ -11,21 +11,36 @@
 
 import argparse
 import base64
+import functools
+import io
 import json
 import logging as log
 import os
 import stat
 import subprocess
-import shutil
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection
 import uuid
 import boto3
+import botocore.config
 import botocore.exceptions
-from OpenSSL import crypto
+from boto3.s3.transfer import TransferConfig
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
 import hashlib
 
+# orjson parses JSON several times faster than the stdlib; fall back to
+# the stdlib decoder when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # FUNCTIONS --------------------------------------------------------------------
 
 
@@ -42,7 +57,7 @@ def cloudwatch_log(cloudwatch_log_group, log_file_path, id_path, region, access_
     :param access_key_id: aws access key
     :param access_key_secret: aws secret key
     """
-    global read_node_id, log_file
+    global log_file
     # Constants
     megabyte = 1048576  # Size of one megabyte in bytes
     max_size = 100 * megabyte  # Maximum log file size before truncation
@@ -65,8 +80,14 @@ def cloudwatch_log(cloudwatch_log_group, log_file_path, id_path, region, access_
 
     last_push_time = time.time()
     while True:
+        last_position = log_file.tell()
         event_buffer, log_events, events_size = process_line(event_buffer, log_events, events_size)
 
+        # If no new log data arrived, wait briefly instead of spinning
+        # on readline at 100% CPU
+        if log_file.tell() == last_position:
+            time.sleep(0.1)
+
         # Check if we should send events to cloudwatch
         log_event_size = 26
         is_over_max_size = len(event_buffer.encode(encoding='utf-8')) + log_event_size + events_size > max_send_size
@@ -85,10 +106,12 @@ def cloudwatch_log(cloudwatch_log_group, log_file_path, id_path, region, access_
         log.debug("Current Log Size: {}".format(log_size))
 
         if log_size > max_size:
-            # Clear the log file
+            # Truncate in place: the writers append with O_APPEND so
+            # their next write lands at the new end of file, and there
+            # is no window where the log file does not exist
             log.warning("Log has reached maximum size. Clearing...")
-            log_file.close()
-            log_file = open(log_file_path, "w+")
+            os.truncate(log_file_path, 0)
+            log_file.seek(0)
             log.info("Log has been cleared. New Size: {}".format(
                 os.path.getsize(log_file_path)))
 
@@ -104,7 +127,7 @@ def init(log_file_path, id_path, region, cloudwatch_log_group, access_key_id, ac
     :param access_key_secret: AWS access key secret
     :return client, log_stream_name, upload_sequence_token:
     """
-    global log_file, read_node_id
+    global log_file
     upload_sequence_token = ""
     if not log_file:
         # Wait for log file to exist
@@ -113,16 +136,17 @@ def init(log_file_path, id_path, region, cloudwatch_log_group, access_key_id, ac
 
         log_file = open(log_file_path, 'r+')
 
-    # Setup cloudwatch logs client
+    # Setup cloudwatch logs client, sharing the tuned connection config
+    # (keepalive, pooling, adaptive retries) with the S3 client
     client = boto3.client('logs', region_name=region,
                           aws_access_key_id=access_key_id,
-                          aws_secret_access_key=access_key_secret)
+                          aws_secret_access_key=access_key_secret,
+                          config=boto_config)
 
     # Define prefix for log stream - should be ID based on file
-    if read_node_id:
-        log_prefix = read_node_id
-    # Read node ID from the file
-    else:
+    log_prefix = read_id_file(id_path)
+    if not log_prefix:
+        # Wait for the node ID file to appear
         log.info("Waiting for ID file...")
         while not os.path.exists(id_path):
             time.sleep(0.1)
@@ -244,11 +268,10 @@ def send(client, upload_sequence_token, log_events, log_stream_name, cloudwatch_
         return upload_sequence_token
 
 
-def download(src_path, dst_path, s3_bucket, region,
-             access_key_id, access_key_secret):
+def download(src_path, dst_path, s3_bucket):
     """
     Downloads file at src_path on s3_bucket to dst_path using
-    the provided access_key_id and access_key_secret.
+    the shared S3 client.
 
     :param src_path: Path of file on S3 bucket
     :type src_path: str
@@ -256,21 +279,12 @@ def download(src_path, dst_path, s3_bucket, region,
     :type dst_path: str
     :param s3_bucket: Name of S3 bucket
     :type s3_bucket: str
-    :param region: Region of S3 bucket
-    :type region: str
-    :param access_key_id: Access key ID for bucket access
-    :type access_key_id: str
-    :param access_key_secret: Access key secret for bucket access
-    :type access_key_secret: str
     :return: None
     :rtype: None
     """
     try:
-        s3 = boto3.Session(
-            aws_access_key_id=access_key_id,
-            aws_secret_access_key=access_key_secret,
-            region_name=region).resource("s3")
-        s3.Bucket(s3_bucket).download_file(src_path, dst_path)
+        s3_client.download_file(s3_bucket, src_path, dst_path,
+                                Config=transfer_config)
         log.debug("Successfully downloaded to {} from {}/{}".format(dst_path,
                                                                     s3_bucket,
                                                                     src_path))
@@ -279,6 +293,118 @@ def download(src_path, dst_path, s3_bucket, region,
                   exc_info=True)
 
 
+def fetch_if_modified(src_path, s3_bucket, etag):
+    """
+    Fetches file at src_path on s3_bucket into memory only when its
+    ETag differs from the provided one. Unchanged files cost a tiny
+    304 response instead of a full GET. Control files are KB-sized, so
+    a plain get_object avoids TransferManager and temp file overhead.
+
+    :param src_path: Path of file on S3 bucket
+    :type src_path: str
+    :param s3_bucket: Name of S3 bucket
+    :type s3_bucket: str
+    :param etag: ETag from the previous fetch, empty string if none
+    :type etag: str
+    :return: The file contents and new ETag if the file changed,
+             otherwise None and the given ETag
+    :rtype: bytes, str
+    """
+    try:
+        response = s3_client.get_object(Bucket=s3_bucket, Key=src_path,
+                                        IfNoneMatch=etag)
+        log.debug("Successfully fetched {}/{}".format(s3_bucket, src_path))
+        return response['Body'].read(), response['ETag']
+    except botocore.exceptions.ClientError as error:
+        code = error.response.get('Error', dict()).get('Code', "")
+        if code in ("304", "NotModified"):
+            log.debug("{} unchanged, skipping download".format(src_path))
+        else:
+            log.error("Unable to download {} from S3: {}".format(src_path,
+                                                                 error),
+                      exc_info=True)
+        return None, etag
+    except Exception as error:
+        log.error("Unable to download {} from S3: {}".format(src_path, error),
+                  exc_info=True)
+        return None, etag
+
+
+def sha256_file(file_path):
+    """
+    Computes the SHA256 hex digest of the file at file_path, reading
+    in chunks so memory usage stays bounded regardless of file size.
+
+    :param file_path: Path of the file to hash
+    :type file_path: str
+    :return: Hex digest of the file contents
+    :rtype: str
+    """
+    with open(file_path, 'rb') as hash_file:
+        # file_digest (Python 3.11+) hashes via a zero-copy readinto loop
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(hash_file, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: hash_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+# Cache of file hashes keyed by (path, mtime, size), so files that
+# have not changed are never rehashed
+sha256_cache = dict()
+
+
+def cached_sha256(file_path):
+    """
+    Computes the SHA256 hex digest of the file at file_path, memoized
+    on the file's (path, mtime, size) so repeated checks of an
+    unchanged file cost a single stat.
+
+    :param file_path: Path of the file to hash
+    :type file_path: str
+    :return: Hex digest of the file contents, or None if it is missing
+    :rtype: str
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return None
+    key = (file_path, file_stat.st_mtime_ns, file_stat.st_size)
+    if key not in sha256_cache:
+        sha256_cache[key] = sha256_file(file_path)
+    return sha256_cache[key]
+
+
+def finish_install(target, install_path):
+    """
+    finish_install applies the target-specific permissions to a file
+    that has landed at its install path, and exits the wrapper when the
+    wrapper itself was the file installed so it restarts into the new
+    version.
+
+    :param target: The install target from the update command
+    :type target: str
+    :param install_path: The local path the file was installed to
+    :type install_path: str
+    :return: Nothing
+    :rtype: None
+    """
+    # Handle binary updates
+    if target == Targets.BINARY or target == Targets.CONSENSUS_BINARY:
+        os.chmod(install_path, stat.S_IEXEC)
+
+    # Handle configuration updates
+    if target == Targets.CONSENSUS_CONFIG or target == Targets.CONSENSUS_STATE:
+        os.chmod(install_path, stat.S_IREAD)
+
+    # Handle Wrapper updates
+    if target == Targets.WRAPPER:
+        os.chmod(install_path, stat.S_IEXEC | stat.S_IREAD)
+        log.info("Wrapper script updated, exiting now...")
+        os._exit(0)
+
+
 def start_binary(bin_path, log_file_path, bin_args):
     """
     Starts the binary at the given path with the given args.
@@ -320,33 +446,58 @@ def terminate_process(p):
 
 # generated_uuid is a static cached UUID used as the node_id
 generated_uuid = None
-# read_node_id is a static cached node id when we successfully read it
-read_node_id = None
 
 
-def get_node_id(id_path):
+@functools.lru_cache(maxsize=4)
+def _read_id(id_path, mtime_ns):
     """
-    Obtain the ID of the running node.
+    Parses the node ID file. Cached on (path, mtime) so an unchanged
+    file is never stat-read-parsed twice.
 
     :param id_path: the path to the node id
     :type id_path: str
-    :return: The node id OR a UUID by host and time if node id file absent
+    :param mtime_ns: modification time of the file, for cache keying
+    :type mtime_ns: int
+    :return: The node id from the file, or None if the field is absent
+    :rtype: str
+    """
+    with open(id_path, 'r') as id_file:
+        return json_loads(id_file.read().strip()).get("id", None)
+
+
+def read_id_file(id_path):
+    """
+    Reads the node ID from the file at id_path.
+
+    :param id_path: the path to the node id
+    :type id_path: str
+    :return: The node id, or None if the file is absent or unreadable
     :rtype: str
     """
-    global generated_uuid, read_node_id
-    # if we've already read it successfully from the file, return it
-    if read_node_id:
-        return read_node_id
-    # Read it from the file
     try:
-        if os.path.exists(id_path):
-            with open(id_path, 'r') as id_file:
-                new_node_id = json.loads(id_file.read().strip()).get("id", None)
-                if new_node_id:
-                    read_node_id = new_node_id
-                    return new_node_id
+        mtime_ns = os.stat(id_path).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        return _read_id(id_path, mtime_ns)
     except Exception as error:
         log.warning("Could not open node ID at {}: {}".format(id_path, error))
+        return None
+
+
+def get_node_id(id_path):
+    """
+    Obtain the ID of the running node.
+
+    :param id_path: the path to the node id
+    :type id_path: str
+    :return: The node id OR a UUID by host and time if node id file absent
+    :rtype: str
+    """
+    global generated_uuid
+    node_id = read_id_file(id_path)
+    if node_id:
+        return node_id
 
     # If that fails, then generate, or use the last generated UUID
     if not generated_uuid:
@@ -355,11 +506,36 @@ def get_node_id(id_path):
     return generated_uuid
 
 
+# cached_cert is the public key of the network certificate with the
+# mtime of the file it was loaded from, so reparsing only happens when
+# the cert is replaced (e.g. by an update command)
+cached_cert = (None, None)
+
+
+def load_network_cert(public_key_path):
+    """
+    Loads and caches the network certificate's public key, reparsing
+    the PEM only when the file on disk changes.
+
+    :param public_key_path: The path to the network public key certificate
+    :type public_key_path: str
+    :return: The certificate's public key
+    :rtype: cryptography RSAPublicKey
+    """
+    global cached_cert
+    mtime = os.stat(public_key_path).st_mtime_ns
+    if cached_cert[0] != mtime:
+        with open(public_key_path, 'rb') as cert_file:
+            cert = x509.load_pem_x509_certificate(cert_file.read())
+            cached_cert = (mtime, cert.public_key())
+    return cached_cert[1]
+
+
 def verify_cmd(in_buf, public_key_path):
     """
-    verify_cmd checks the command signature against the network certificate. 
+    verify_cmd checks the command signature against the network certificate.
 
-    :param in_buf: the command file buffer
+    :param in_buf: the command file buffer, opened in binary mode
     :type in_buf: file object
     :param public_key_path: The path to the network public key certificate
     :type public_key_path: str
@@ -367,27 +543,31 @@ def verify_cmd(in_buf, public_key_path):
     :rtype: dict, bool
     """
 
-    with open(public_key_path, 'r') as file:
-        command_json = None
-        try:
-            key = crypto.load_certificate(crypto.FILETYPE_PEM, file.read())
-            cmd = in_buf.readline().strip()
-            command_json = json.loads(cmd)
-            sig_json = json.loads(in_buf.readline())
-            signature = base64.b64decode(sig_json.get('signature'))
-            crypto.verify(key, signature, bytes(cmd, 'utf-8'), 'sha256')
-            return command_json, True
-        except Exception as error:
-            log.error("Unable to verify command: {}".format(error))
-            return command_json, False
+    command_json = None
+    try:
+        public_key = load_network_cert(public_key_path)
+        # Keep the command as the exact bytes that were signed; no
+        # decode/re-encode round trip
+        cmd = in_buf.readline().strip()
+        command_json = json_loads(cmd)
+        sig_json = json_loads(in_buf.readline())
+        signature = base64.b64decode(sig_json.get('signature'))
+        public_key.verify(signature, cmd,
+                          padding.PKCS1v15(), hashes.SHA256())
+        return command_json, True
+    except Exception as error:
+        log.error("Unable to verify command: {}".format(error))
+        return command_json, False
 
 
-def save_cmd(file_path, dest_dir, valid, cmd_time):
+def save_cmd(data, file_name, dest_dir, valid, cmd_time):
     """
-    save_cmd saves the command json files to a log directory
+    save_cmd saves the raw command file bytes to a log directory
 
-    :param file_path: The source path of the command to save
-    :type file_path: str
+    :param data: The contents of the command file
+    :type data: bytes
+    :param file_name: The name of the command file, e.g. command.jsonl
+    :type file_name: str
     :param dest_dir: the destination directory
     :type dest_dir: str
     :param valid: is this a valid command file
@@ -400,12 +580,15 @@ def save_cmd(file_path, dest_dir, valid, cmd_time):
     if not os.path.exists(dest_dir):
         os.makedirs(dest_dir)
 
-    fparts = os.path.basename(file_path).split('.')
+    fparts = file_name.split('.')
     if not valid:
         fparts[0] = "INVALID_{}".format(fparts[0])
     # destdir/command_2849204.json
     dest = "{}/{}_{}.{}".format(dest_dir, fparts[0], int(cmd_time), fparts[1])
-    shutil.copyfile(file_path, dest)
+    if os.path.exists(dest):
+        return
+    with open(dest, 'wb') as dest_file:
+        dest_file.write(data)
 
 
 def get_args():
@@ -496,6 +679,45 @@ s3_management_bucket_name = args["s3managementbucket"]
 s3_access_key_id = args["s3accesskey"]
 s3_access_key_secret = args["s3secret"]
 s3_bucket_region = args["s3region"]
+
+# http.client sends request bodies in 8 KiB blocks by default, which
+# throttles large uploads; raise the default blocksize to 1 MiB before
+# any botocore clients are built
+if 8192 in (HTTPConnection.__init__.__defaults__ or ()):
+    HTTPConnection.__init__.__defaults__ = tuple(
+        1024 * 1024 if default == 8192 else default
+        for default in HTTPConnection.__init__.__defaults__)
+
+# Connection tuning shared by all AWS clients: persistent pooled
+# connections with keepalive and adaptive retries
+boto_config = botocore.config.Config(max_pool_connections=64,
+                                     retries={"max_attempts": 10,
+                                              "mode": "adaptive"},
+                                     tcp_keepalive=True,
+                                     connect_timeout=5,
+                                     read_timeout=60)
+
+# Shared S3 client, created once so every transfer reuses the same
+# credentials, endpoint data and connection pool instead of rebuilding
+# a session on each poll
+s3_client = boto3.client("s3",
+                         aws_access_key_id=s3_access_key_id,
+                         aws_secret_access_key=s3_access_key_secret,
+                         region_name=s3_bucket_region,
+                         config=boto_config)
+
+# Transfer tuning shared by all S3 transfers: stream large objects as
+# parallel multipart chunks instead of a single-threaded GET/PUT
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=16 * 1024 * 1024,
+                                 max_concurrency=10,
+                                 max_io_queue=1000,
+                                 io_chunksize=1024 * 1024,
+                                 use_threads=True)
+
+# Small pool used to fan independent S3 round-trips out in parallel
+s3_pool = ThreadPoolExecutor(max_workers=4)
+
 log_path = args["logpath"]
 os.makedirs(os.path.dirname(args["logpath"]), exist_ok=True)
 
@@ -566,6 +788,15 @@ if not args["disable_cloudwatch"]:
 
 # Frequency (in seconds) of checking for new commands
 command_frequency = 10
+# Maximum interval between S3 polls when nothing is changing
+max_command_frequency = 60
+# Current interval between S3 polls, backed off while the remote files
+# are idle; local checks are unaffected and run every tick
+poll_interval = command_frequency
+# Time of the last conditional fetch of the remote control files
+last_fetch_time = 0
+# Last seen ETag for each remote control file
+etags = ["" for _ in remotes_paths]
 log.info("Script initialized at {}".format(time.time()))
 
 # Main command/control loop
@@ -590,34 +821,52 @@ while True:
         except IOError as err:
             log.error(err)
 
+    # Honor the idle backoff for the S3 polls only; the crash-recovery
+    # check above still runs every tick
+    if time.time() - last_fetch_time < poll_interval:
+        continue
+    last_fetch_time = time.time()
+
+    # Obtain the latest command files concurrently; each is an
+    # independent network round-trip. Conditional GETs make unchanged
+    # files cost a 304 instead of a full download.
+    fetch_futures = [
+        s3_pool.submit(fetch_if_modified, remote_path,
+                       s3_management_bucket_name, etags[i])
+        for i, remote_path in enumerate(remotes_paths)]
+
+    # Track whether anything changed this tick to adapt the poll rate
+    remotes_changed = False
+
     for i, remote_path in enumerate(remotes_paths):
         try:
-            # Obtain the latest command file
-            local_path = "{}/{}".format(tmp_dir, os.path.basename(remote_path))
-            download(remote_path, local_path,
-                     s3_management_bucket_name, s3_bucket_region,
-                     s3_access_key_id, s3_access_key_secret)
-
-            # Load the command file into JSON
-            with open(local_path, 'r') as cmd_file:
-
-                # Verify the command file signature
-                signed_commands, ok = verify_cmd(cmd_file, rsa_certificate_path)
-                if signed_commands is None:
-                    log.error("Empty command file: {}".format(local_path))
-                    save_cmd(local_path, cmd_log_dir, False, time.time())
-                    continue
-
-                # Handle invalid signature
-                if not ok:
-                    log.error("Failed to verify signature for {}!".format(
-                        local_path), exc_info=True)
-                    save_cmd(local_path, cmd_log_dir, ok, time.time())
-                    continue
+            file_name = os.path.basename(remote_path)
+
+            # Skip files that have not changed since the last poll
+            body, new_etag = fetch_futures[i].result()
+            if body is None:
+                continue
+            etags[i] = new_etag
+            remotes_changed = True
+
+            # Verify the command file signature from the in-memory copy
+            signed_commands, ok = verify_cmd(io.BytesIO(body),
+                                             rsa_certificate_path)
+            if signed_commands is None:
+                log.error("Empty command file: {}".format(remote_path))
+                save_cmd(body, file_name, cmd_log_dir, False, time.time())
+                continue
+
+            # Handle invalid signature
+            if not ok:
+                log.error("Failed to verify signature for {}!".format(
+                    remote_path), exc_info=True)
+                save_cmd(body, file_name, cmd_log_dir, ok, time.time())
+                continue
 
             # Save the command into a log
             timestamp = signed_commands.get("timestamp", 0)
-            save_cmd(local_path, cmd_log_dir, ok, timestamp)
+            save_cmd(body, file_name, cmd_log_dir, ok, timestamp)
 
             # If the commands occurred before the script, skip
             # Note: We do not update unless we get a command we
@@ -705,17 +954,28 @@ while True:
                     update_path = "{}/{}".format(management_directory, info.get("path", ""))
                     log.info("Updating file at {} to {}...".format(update_path, install_path))
 
+                    # Skip the download when the installed file already
+                    # matches the requested hash
+                    expected_hash = info.get("sha256sum", "")
+                    if expected_hash and \
+                            cached_sha256(install_path) == expected_hash:
+                        log.info("{} already matches hash {}, skipping "
+                                 "download".format(install_path,
+                                                   expected_hash))
+                        # Still apply permissions (and restart for
+                        # wrapper updates) in case a previous attempt
+                        # died between install and chmod
+                        finish_install(target, install_path)
+                        timestamps[i] = timestamp
+                        continue
+
                     # Make directories and download file to temporary location
                     os.makedirs(os.path.dirname(install_path), exist_ok=True)
                     tmp_path = install_path + ".tmp"
-                    download(update_path, tmp_path,
-                             s3_management_bucket_name, s3_bucket_region,
-                             s3_access_key_id, s3_access_key_secret)
+                    download(update_path, tmp_path, s3_management_bucket_name)
 
                     # Ensure the hash of the downloaded file matches the command
-                    update_bytes = bytes(open(tmp_path, 'rb').read())
-                    actual_hash = hashlib.sha256(update_bytes).hexdigest()
-                    expected_hash = info.get("sha256sum", "")
+                    actual_hash = sha256_file(tmp_path)
                     if actual_hash != expected_hash:
                         log.error("Binary {} does not match hash {}".format(
                             tmp_path, expected_hash))
@@ -731,19 +991,8 @@ while True:
                         timestamps[i] = timestamp
                         continue
 
-                    # Handle binary updates
-                    if target == Targets.BINARY or target == Targets.CONSENSUS_BINARY:
-                        os.chmod(install_path, stat.S_IEXEC)
-
-                    # Handle configuration updates
-                    if target == Targets.CONSENSUS_CONFIG or target == Targets.CONSENSUS_STATE:
-                        os.chmod(install_path, stat.S_IREAD)
-
-                    # Handle Wrapper updates
-                    if target == Targets.WRAPPER:
-                        os.chmod(install_path, stat.S_IEXEC | stat.S_IREAD)
-                        log.info("Wrapper script updated, exiting now...")
-                        os._exit(0)
+                    # Apply permissions, restarting on wrapper updates
+                    finish_install(target, install_path)
 
                 log.info("Completed command: {}".format(command))
 
@@ -752,3 +1001,12 @@ while True:
         except Exception as err:
             log.error("Unable to execute commands: {}".format(err),
                       exc_info=True)
+            # Forget the recorded ETag so the next tick refetches and
+            # retries the commands instead of short-circuiting on a 304
+            etags[i] = ""
+
+    # Back off while the remote files are idle, reset once they change
+    if remotes_changed:
+        poll_interval = command_frequency
+    else:
+        poll_interval = min(poll_interval * 2, max_command_frequency)